@@ -1,6 +1,10 @@
+import os
 import json
 import random
 import math
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+import numpy as np
 import pandas as pd
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
@@ -76,10 +80,18 @@ def process_request(request):
     spreadsheet_id = request_data.get('spreadsheetId')
     sheet_name = request_data.get('sheetName')
     preferences = request_data.get('preferences', {})
+    algorithm = request_data.get('algorithm', 'annealing')
+    time_limit = request_data.get('timeLimit')
 
     if not token or not spreadsheet_id or not sheet_name:
         return ('Missing token, spreadsheet ID, or sheet name', 400, headers)
 
+    if not isinstance(algorithm, str) or algorithm not in SOLVERS:
+        return (f"Unknown algorithm '{algorithm}'", 400, headers)
+
+    if not valid_time_limit(time_limit):
+        return (f'timeLimit must be a positive number of seconds up to {MAX_TIME_LIMIT}', 400, headers)
+
     try:
         creds = Credentials(token)
         service = build('sheets', 'v4', credentials=creds)
@@ -91,19 +103,7 @@ def process_request(request):
         if not data:
             return ('No data found in the sheet.', 400, headers)
         
-        df = pd.DataFrame(data[1:], columns=data[0])
-        dances, members = read_data(df)
-        
-        # Run the simulated annealing algorithm with preferences applied
-        results = []
-        for _ in range(3):
-            best_schedule, best_cost = simulated_annealing(dances, members, preferences=preferences)
-            collision_details = get_collision_details(best_schedule, members)
-            results.append({
-                'schedule': best_schedule,
-                'cost': best_cost,
-                'collisions': collision_details
-            })
+        results = solve_sheet(data, preferences, algorithm, time_limit, workers=available_workers())
 
         return (json.dumps({'results': results}), 200, {**headers, 'Content-Type': 'application/json'})
 
@@ -113,6 +113,207 @@ def process_request(request):
         return (error_message, 500, headers)
 
 
+# Process several sheets in one request: one batchGet per spreadsheet, solved concurrently
+def process_batch_request(request):
+    # Set CORS headers for preflight requests
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+
+    headers = {'Access-Control-Allow-Origin': '*'}
+
+    request_data = request.get_json(silent=True)
+    if not request_data:
+        return ('Invalid JSON payload', 400, headers)
+
+    token = request_data.get('token')
+    default_spreadsheet_id = request_data.get('spreadsheetId')
+    default_preferences = request_data.get('preferences', {})
+    default_algorithm = request_data.get('algorithm', 'annealing')
+    default_time_limit = request_data.get('timeLimit')
+    sheets = request_data.get('sheets')
+
+    if not token or not isinstance(sheets, list) or not sheets:
+        return ('Missing token or sheets list', 400, headers)
+
+    if len(sheets) > MAX_BATCH_SHEETS:
+        return (f'At most {MAX_BATCH_SHEETS} sheets can be processed in one batch', 400, headers)
+
+    # Each entry is either a sheet name or an object with sheetName and
+    # optional spreadsheetId / preferences / algorithm / timeLimit overriding the request defaults
+    jobs = []
+    for entry in sheets:
+        if isinstance(entry, str):
+            entry = {'sheetName': entry}
+        if not isinstance(entry, dict):
+            entry = {}
+        jobs.append({
+            'spreadsheetId': entry.get('spreadsheetId', default_spreadsheet_id),
+            'sheetName': entry.get('sheetName'),
+            'preferences': entry.get('preferences', default_preferences),
+            'algorithm': entry.get('algorithm', default_algorithm),
+            'timeLimit': entry.get('timeLimit', default_time_limit)
+        })
+
+    # Reject bad entries up front so they never cost a fetch or a worker
+    errors = {}
+    for i, job in enumerate(jobs):
+        if not job['spreadsheetId'] or not job['sheetName']:
+            errors[i] = 'Missing spreadsheet ID or sheet name'
+        elif not isinstance(job['algorithm'], str) or job['algorithm'] not in SOLVERS:
+            errors[i] = f"Unknown algorithm '{job['algorithm']}'"
+        elif not valid_time_limit(job['timeLimit']):
+            errors[i] = f'timeLimit must be a positive number of seconds up to {MAX_TIME_LIMIT}'
+
+    try:
+        creds = Credentials(token)
+        service = build('sheets', 'v4', credentials=creds)
+
+        sheet_data = {}
+
+        # Group the remaining sheets by spreadsheet so each spreadsheet is one batchGet
+        by_spreadsheet = {}
+        for i, job in enumerate(jobs):
+            if i not in errors:
+                by_spreadsheet.setdefault(job['spreadsheetId'], []).append(i)
+
+        for spreadsheet_id, indices in by_spreadsheet.items():
+            ranges = [f"'{jobs[i]['sheetName']}'" for i in indices]
+            try:
+                response = service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id, ranges=ranges).execute()
+                value_ranges = response.get('valueRanges', [])
+                if len(value_ranges) != len(indices):
+                    raise ValueError(f"batchGet returned {len(value_ranges)} ranges for {len(indices)} sheets")
+                for i, value_range in zip(indices, value_ranges):
+                    sheet_data[i] = value_range.get('values', [])
+            except Exception:
+                # batchGet fails as a whole if any range is bad (or returns an
+                # incomplete response), so fall back to single-range reads to
+                # find out which sheets are at fault
+                for i, sheet_range in zip(indices, ranges):
+                    try:
+                        sheet = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=sheet_range).execute()
+                        sheet_data[i] = sheet.get('values', [])
+                    except Exception as e:
+                        errors[i] = f"An error occurred: {str(e)}"
+
+        # Solve all fetched sheets concurrently, one worker process per sheet.
+        # A sheet that overruns its budget is reported as timed out; the
+        # executor is not waited on, so it can't hold up the other sheets
+        solved = {}
+        if sheet_data:
+            executor = ProcessPoolExecutor(max_workers=min(len(sheet_data), available_workers()))
+            try:
+                futures = {i: executor.submit(solve_sheet, data, jobs[i]['preferences'], jobs[i]['algorithm'], jobs[i]['timeLimit']) for i, data in sheet_data.items()}
+                for i, future in futures.items():
+                    timeout = (jobs[i]['timeLimit'] or MAX_TIME_LIMIT) + SOLVE_TIMEOUT_SLACK
+                    try:
+                        solved[i] = future.result(timeout=timeout)
+                    except TimeoutError:
+                        errors[i] = f'Solving took longer than {timeout} seconds'
+                    except Exception as e:
+                        errors[i] = f"An error occurred: {str(e)}"
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        batch_results = []
+        for i, job in enumerate(jobs):
+            sheet_result = {'spreadsheetId': job['spreadsheetId'], 'sheetName': job['sheetName']}
+            if i not in errors and i not in solved:
+                errors[i] = 'No result was produced for this sheet'
+            if i in errors:
+                print(f"{job['sheetName']}: {errors[i]}")
+                sheet_result['error'] = errors[i]
+            else:
+                sheet_result['results'] = solved[i]
+            batch_results.append(sheet_result)
+
+        return (json.dumps({'sheets': batch_results}), 200, {**headers, 'Content-Type': 'application/json'})
+
+    except Exception as e:
+        error_message = f"An error occurred: {str(e)}"
+        print(error_message)
+        return (error_message, 500, headers)
+
+
+# Read the raw sheet values and run the selected solver with preferences applied.
+# time_limit is the budget in seconds for the whole sheet (see valid_time_limit)
+# and workers is how many processes the independent runs are spread over
+def solve_sheet(data, preferences, algorithm='annealing', time_limit=None, workers=1):
+    if not data:
+        raise ValueError('No data found in the sheet.')
+    if not isinstance(algorithm, str) or algorithm not in SOLVERS:
+        raise ValueError(f"Unknown algorithm '{algorithm}'")
+    if not valid_time_limit(time_limit):
+        raise ValueError(f'timeLimit must be a positive number of seconds up to {MAX_TIME_LIMIT}')
+
+    df = pd.DataFrame(data[1:], columns=data[0])
+    dances, members = read_data(df)
+
+    # Run the solver with preferences applied. Runs in the same round execute
+    # side by side, so each round gets an equal share of the time budget
+    runs = 3
+    workers = max(1, min(workers, runs))
+    rounds = math.ceil(runs / workers)
+    solver_options = {} if time_limit is None else {'time_limit': time_limit / rounds}
+    seeds = [random.getrandbits(64) for _ in range(runs)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_solver, algorithm, dances, members, preferences, solver_options, seed) for seed in seeds]
+            solutions = [future.result() for future in futures]
+    else:
+        solutions = [run_solver(algorithm, dances, members, preferences, solver_options, seed) for seed in seeds]
+
+    results = []
+    for best_schedule, best_cost in solutions:
+        collision_details = get_collision_details(best_schedule, members)
+        results.append({
+            'schedule': best_schedule,
+            'cost': best_cost,
+            'collisions': collision_details
+        })
+    return results
+
+# Each run seeds random itself so runs in forked worker processes don't repeat each other
+def run_solver(algorithm, dances, members, preferences, solver_options, seed):
+    random.seed(seed)
+    return SOLVERS[algorithm](dances, members, preferences=preferences, **solver_options)
+
+# Number of worker processes this function may use: the CPUs it is allowed to
+# run on, optionally capped by the SOLVER_MAX_WORKERS environment variable
+def available_workers():
+    try:
+        workers = len(os.sched_getaffinity(0))
+    except AttributeError:
+        workers = os.cpu_count() or 1
+    cap = os.environ.get('SOLVER_MAX_WORKERS', '')
+    if cap.isdigit() and int(cap) > 0:
+        workers = min(workers, int(cap))
+    return max(1, workers)
+
+# Longest timeLimit a client may ask for, kept well below the function timeout
+MAX_TIME_LIMIT = 30
+
+# Extra seconds a batch sheet gets on top of its budget for parsing and process startup
+SOLVE_TIMEOUT_SLACK = 10
+
+# Most sheets a single batch request may ask for
+MAX_BATCH_SHEETS = 20
+
+# timeLimit is the most wall-clock seconds a sheet may spend solving. It is a
+# cap for every solver: each one still stops at its own iteration/generation
+# cap or at zero collisions, whichever comes first
+def valid_time_limit(time_limit):
+    if time_limit is None:
+        return True
+    return isinstance(time_limit, (int, float)) and not isinstance(time_limit, bool) and 0 < time_limit <= MAX_TIME_LIMIT
+
+
 # Reusable function to read dance data
 def read_data(df):
     dances = []
@@ -198,8 +399,11 @@ def get_collision_details(schedule, members):
             member_last_dance[member] = idx
     return collisions
 
-def simulated_annealing(dances, members, preferences=None, max_iter=10000, initial_temp=1000, cooling_rate=0.003):
+# Build the starting schedule: fixed positions, then Start dances at the front,
+# End dances at the back and the rest shuffled into the middle
+def build_initial_schedule(dances, preferences):
     # Extract preferences
+    preferences = preferences or {}
     fixed_positions = preferences.get('fixedPositions', [])
     start_dances = preferences.get('Start', [])
     middle_dances = preferences.get('Middle', [])
@@ -232,12 +436,18 @@ def simulated_annealing(dances, members, preferences=None, max_iter=10000, initi
     for idx, dance in fixed_indices.items():
         schedule[idx] = dance
 
+    # Zone of each position: 'fixed', 'Start', 'Middle' or 'End'
+    zones = ['Middle'] * schedule_length
+    for idx in fixed_indices:
+        zones[idx] = 'fixed'
+
     # Place Start dances at the beginning
     idx = 0
     for dance in start_dances:
         while schedule[idx] is not None:
             idx += 1
         schedule[idx] = dance
+        zones[idx] = 'Start'
         idx += 1
 
     # Place End dances at the end
@@ -246,6 +456,7 @@ def simulated_annealing(dances, members, preferences=None, max_iter=10000, initi
         while schedule[idx] is not None:
             idx -= 1
         schedule[idx] = dance
+        zones[idx] = 'End'
         idx -= 1
 
     # Remaining positions are for Middle dances and available dances
@@ -257,12 +468,19 @@ def simulated_annealing(dances, members, preferences=None, max_iter=10000, initi
         if schedule[idx] is None:
             schedule[idx] = middle_and_available.pop()
 
+    return schedule, fixed_indices, zones
+
+def simulated_annealing(dances, members, preferences=None, max_iter=10000, initial_temp=1000, cooling_rate=0.003, time_limit=None):
+    # Build the initial schedule from preferences
+    schedule, fixed_indices, _ = build_initial_schedule(dances, preferences)
+
     # Now, schedule is the initial schedule
     current_schedule = schedule[:]
     current_cost = calculate_collisions(current_schedule, members)
     best_schedule = current_schedule[:]
     best_cost = current_cost
     temp = initial_temp
+    deadline = None if time_limit is None else time.monotonic() + time_limit
 
     # Indices of dances that can be swapped (excluding fixed positions)
     swap_indices = [i for i in range(len(current_schedule)) if i not in fixed_indices]
@@ -271,6 +489,8 @@ def simulated_annealing(dances, members, preferences=None, max_iter=10000, initi
         temp = temp * (1 - cooling_rate)
         if temp <= 0:
             break
+        if deadline is not None and time.monotonic() > deadline:
+            break
 
         # Create a new neighbor by swapping two dances (excluding fixed positions)
         if len(swap_indices) < 2:
@@ -298,3 +518,216 @@ def simulated_annealing(dances, members, preferences=None, max_iter=10000, initi
             break
 
     return best_schedule, best_cost
+
+
+# Pairwise conflict counts: conflicts[a, b] is the number of collisions when dance b directly follows dance a
+def build_conflict_matrix(dances, members):
+    member_sets = [set(members[dance]) for dance in dances]
+    conflicts = np.zeros((len(dances), len(dances)), dtype=np.int64)
+    for a, previous_members in enumerate(member_sets):
+        for b, dance in enumerate(dances):
+            if a != b:
+                conflicts[a, b] = sum(1 for member in members[dance] if member in previous_members)
+    return conflicts
+
+# Padded conflict matrix and legal swap mask shared by the swap-based solvers
+def build_swap_model(dances, members, zones):
+    # Pad with a dummy dance that conflicts with nothing, placed before the
+    # first and after the last position so the ends need no special casing
+    dummy = len(dances)
+    conflicts = np.zeros((dummy + 1, dummy + 1), dtype=np.int64)
+    conflicts[:dummy, :dummy] = build_conflict_matrix(dances, members)
+
+    # A swap is legal when both positions are movable and in the same zone,
+    # so Start/End dances stay in their zones and fixed positions never move
+    positions = np.arange(len(zones))
+    zone_ids = np.array([['fixed', 'Start', 'Middle', 'End'].index(zone) for zone in zones])
+    movable = zone_ids != 0
+    legal = (positions[:, None] < positions[None, :]) & movable[:, None] & movable[None, :] & (zone_ids[:, None] == zone_ids[None, :])
+    return conflicts, legal
+
+# Initial schedule and swap model for the swap-based solvers. `current` is the
+# schedule as dance indices, or None when there is no legal swap to search
+def prepare_swap_search(dances, members, preferences):
+    schedule, _, zones = build_initial_schedule(dances, preferences)
+    if len(schedule) < 2:
+        return schedule, zones, None, None, None
+
+    conflicts, legal = build_swap_model(dances, members, zones)
+    if not legal.any():
+        return schedule, zones, None, None, None
+
+    index_of = {dance: i for i, dance in enumerate(dances)}
+    current = np.array([index_of[dance] for dance in schedule], dtype=np.int64)
+    return schedule, zones, current, conflicts, legal
+
+# Cost change of every swap (i, j) for one schedule or a whole population of them
+def swap_deltas(schedules, conflicts):
+    dummy = conflicts.shape[0] - 1
+    pad = np.full(schedules.shape[:-1] + (1,), dummy)
+    padded = np.concatenate((pad, schedules, pad), axis=-1)
+
+    # prev/this/nxt are the dances before, at and after each position
+    prev, this, nxt = padded[..., :-2], padded[..., 1:-1], padded[..., 2:]
+    left = conflicts[prev, this]
+    right = conflicts[this, nxt]
+    delta = (conflicts[prev[..., :, None], this[..., None, :]] + conflicts[this[..., None, :], nxt[..., :, None]]
+             + conflicts[prev[..., None, :], this[..., :, None]] + conflicts[this[..., :, None], nxt[..., None, :]]
+             - left[..., :, None] - right[..., :, None] - left[..., None, :] - right[..., None, :])
+
+    # Neighbouring positions share an edge, so score them directly
+    adjacent = np.arange(schedules.shape[-1] - 1)
+    delta[..., adjacent, adjacent + 1] = (conflicts[prev[..., adjacent], this[..., adjacent + 1]] + conflicts[this[..., adjacent + 1], this[..., adjacent]]
+                                          + conflicts[this[..., adjacent], nxt[..., adjacent + 1]]
+                                          - left[..., adjacent] - right[..., adjacent] - right[..., adjacent + 1])
+    return delta
+
+def tabu_search(dances, members, preferences=None, max_iter=1000, tenure=None, time_limit=None):
+    # Build the initial schedule from preferences
+    schedule, zones, current, conflicts, legal = prepare_swap_search(dances, members, preferences)
+    if current is None:
+        return schedule, calculate_collisions(schedule, members)
+
+    if tenure is None:
+        tenure = max(1, sum(1 for zone in zones if zone != 'fixed') // 4)
+    tabu_until = np.zeros(len(dances), dtype=np.int64)
+
+    current_cost = int(conflicts[current[:-1], current[1:]].sum())
+    best = current.copy()
+    best_cost = current_cost
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+
+    for iteration in range(max_iter):
+        if best_cost == 0:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            break
+
+        # Score every swap at once
+        delta = swap_deltas(current, conflicts)
+
+        # Moves touching a tabu dance are only allowed if they beat the best cost (aspiration)
+        tabu = (tabu_until[current][:, None] > iteration) | (tabu_until[current][None, :] > iteration)
+        allowed = legal & (~tabu | (current_cost + delta < best_cost))
+        if not allowed.any():
+            allowed = legal
+
+        scores = np.where(allowed, delta, np.iinfo(np.int64).max)
+        candidates = np.flatnonzero(scores == scores.min())
+        idx1, idx2 = np.unravel_index(random.choice(candidates), scores.shape)
+
+        current_cost += int(delta[idx1, idx2])
+        current[idx1], current[idx2] = current[idx2], current[idx1]
+        tabu_until[current[idx1]] = tabu_until[current[idx2]] = iteration + 1 + tenure
+
+        if current_cost < best_cost:
+            best = current.copy()
+            best_cost = current_cost
+
+    best_schedule = [dances[i] for i in best]
+    return best_schedule, best_cost
+
+def memetic_search(dances, members, preferences=None, population_size=40, generations=200, mutation_rate=0.3, polish_steps=5, polish_fraction=0.25, elite=2, patience=30, time_limit=None):
+    # Build the initial schedule from preferences
+    schedule, zones, base, conflicts, legal = prepare_swap_search(dances, members, preferences)
+    if base is None:
+        return schedule, calculate_collisions(schedule, members)
+
+    # Positions of each zone; dances only ever move within their own zone, so
+    # every individual keeps the same fixed, Start and End dances in place
+    zone_positions = [np.array([idx for idx, z in enumerate(zones) if z == zone]) for zone in ['Start', 'Middle', 'End']]
+    zone_positions = [positions for positions in zone_positions if len(positions) >= 2]
+
+    # Seed NumPy from the random module so seeding random reproduces the whole run
+    rng = np.random.default_rng(random.getrandbits(64))
+    elite = min(elite, population_size - 1)
+
+    # Population of permutations, each a shuffle of the base schedule within zones
+    def random_population(count):
+        schedules = np.tile(base, (count, 1))
+        for positions in zone_positions:
+            schedules[:, positions] = rng.permuted(schedules[:, positions], axis=1)
+        return schedules
+
+    population = random_population(population_size)
+
+    def fitness(schedules):
+        return conflicts[schedules[:, :-1], schedules[:, 1:]].sum(axis=1)
+
+    costs = fitness(population)
+    best = population[np.argmin(costs)].copy()
+    best_cost = int(costs.min())
+    last_improvement = 0
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+
+    # Stop after `generations` or when the time budget runs out. Without a
+    # budget, also stop once the population stagnates; with one, restart
+    # everyone but the elite instead and use the remaining time
+    for generation in range(generations):
+        if best_cost == 0:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            break
+        if generation - last_improvement >= patience:
+            if deadline is None:
+                break
+            population = np.concatenate((population[np.argsort(costs)[:elite]], random_population(population_size - elite)))
+            costs = fitness(population)
+            last_improvement = generation
+
+        # Binary tournament selection of two parents per offspring
+        offspring_count = population_size - elite
+        contenders = rng.integers(population_size, size=(offspring_count, 2, 2))
+        winners = np.where(costs[contenders[..., 0]] <= costs[contenders[..., 1]], contenders[..., 0], contenders[..., 1])
+
+        offspring = population[winners[:, 0]].copy()
+        for child, second in zip(offspring, population[winners[:, 1]]):
+            # Order crossover within each zone: keep a slice of the first parent
+            # and fill the rest of the zone in the order of the second parent
+            for positions in zone_positions:
+                cut1, cut2 = np.sort(rng.choice(len(positions) + 1, size=2, replace=False))
+                kept = child[positions[cut1:cut2]]
+                rest = second[positions][~np.isin(second[positions], kept)]
+                child[positions] = np.concatenate((rest[:cut1], kept, rest[cut1:]))
+
+            # Mutation by swapping two dances in the same zone
+            if rng.random() < mutation_rate:
+                positions = zone_positions[rng.integers(len(zone_positions))]
+                idx1, idx2 = rng.choice(positions, size=2, replace=False)
+                child[idx1], child[idx2] = child[idx2], child[idx1]
+
+        # Polish the most promising offspring together with a few steps of
+        # steepest descent; scoring every swap is the expensive part, so the
+        # rest of the generation is left to selection
+        polish_count = max(1, int(offspring_count * polish_fraction))
+        rows = np.argsort(fitness(offspring))[:polish_count]
+        for _ in range(polish_steps):
+            delta = np.where(legal, swap_deltas(offspring[rows], conflicts), 0)
+            moves = delta.reshape(len(rows), -1).argmin(axis=1)
+            improving = delta.reshape(len(rows), -1)[np.arange(len(rows)), moves] < 0
+            if not improving.any():
+                break
+            idx1, idx2 = np.unravel_index(moves[improving], legal.shape)
+            rows = rows[improving]
+            offspring[rows, idx1], offspring[rows, idx2] = offspring[rows, idx2], offspring[rows, idx1]
+
+        # Keep the elite and replace everyone else with the offspring
+        elites = population[np.argsort(costs)[:elite]]
+        population = np.concatenate((elites, offspring))
+        costs = fitness(population)
+
+        if costs.min() < best_cost:
+            best = population[np.argmin(costs)].copy()
+            best_cost = int(costs.min())
+            last_improvement = generation
+
+    best_schedule = [dances[i] for i in best]
+    return best_schedule, best_cost
+
+
+# Solvers selectable through the 'algorithm' field of the request payload
+SOLVERS = {
+    'annealing': simulated_annealing,
+    'tabu': tabu_search,
+    'memetic': memetic_search,
+}